@@ -1,12 +1,26 @@
 # ================= IMPORTS =================
+import glob
+import os
+import re
 import streamlit as st
 import duckdb
-import pandas as pd
 
 # ================= CONFIG =================
 CSV_PATH = "conversation_bi_output_FAST.csv"
 DB_PATH = "conversation_bi.duckdb"
 TABLE_NAME = "conversations"
+AGG_TABLE = "conv_agg"
+META_TABLE = "build_meta"
+# sized for a small aggregate workload rather than DuckDB's whole-machine defaults
+DUCKDB_CONFIG = {
+    "threads": min(8, os.cpu_count() or 1),
+    "memory_limit": "2GB",
+}
+ENUM_COLUMNS = {
+    "issue_type": "issue_t",
+    "sentiment": "sentiment_t",
+    "resolution_status": "status_t",
+}
 
 # ================= PAGE SETUP =================
 st.set_page_config(page_title="Conversational BI", layout="wide")
@@ -14,169 +28,404 @@ st.title("🧠 Conversational BI")
 st.caption("Ask anything. System detects intent and shows the right output.")
 
 # ================= LOAD DATA =================
-@st.cache_data
-def load_df():
-    return pd.read_csv(CSV_PATH)
+def remove_quietly(paths):
+    # best effort: Windows keeps any file another process still holds open
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def build_db(csv_mtime):
+    # builds that crashed earlier left their temp files under PIDs that will
+    # not come back; nothing else ever removes them
+    remove_quietly(glob.glob(f"{glob.escape(DB_PATH)}.*.tmp*"))
+
+    # build into a private file and swap it in whole, so a crash mid-build
+    # never leaves DB_PATH half-written
+    tmp_path = f"{DB_PATH}.{os.getpid()}.tmp"
+
+    with duckdb.connect(tmp_path, config=DUCKDB_CONFIG) as con:
+        # DuckDB reads the CSV itself; no pandas copy
+        con.execute(f"""
+        CREATE TABLE {TABLE_NAME} AS
+        SELECT * FROM read_csv_auto(?, sample_size=-1)
+        """, [CSV_PATH])
+        # low-cardinality labels are stored as ENUM codes instead of strings
+        for column, enum_type in ENUM_COLUMNS.items():
+            con.execute(f"""
+            CREATE TYPE {enum_type} AS ENUM (
+                SELECT DISTINCT {column} FROM {TABLE_NAME}
+                WHERE {column} IS NOT NULL
+                ORDER BY 1
+            )
+            """)
+            con.execute(f"ALTER TABLE {TABLE_NAME} ALTER {column} TYPE {enum_type}")
+        # every question is answered from this small cube, not the raw table
+        con.execute(f"""
+        CREATE TABLE {AGG_TABLE} AS
+        SELECT issue_type, sentiment, resolution_status, COUNT(*) AS count
+        FROM {TABLE_NAME}
+        GROUP BY issue_type, sentiment, resolution_status
+        """)
+        # records which CSV version this file was built from
+        con.execute(f"CREATE TABLE {META_TABLE} AS SELECT ? AS csv_mtime", [csv_mtime])
+
+    # closing checkpointed everything into tmp_path, so it needs no WAL.
+    # DuckDB 1.5 cannot replay a WAL holding the ENUM ALTER ... TYPE, so a WAL
+    # left by an earlier crash must never be paired with the new file
+    try:
+        if os.path.exists(f"{DB_PATH}.wal"):
+            os.remove(f"{DB_PATH}.wal")
+        os.replace(tmp_path, DB_PATH)
+    except OSError:
+        # Windows refuses to replace a file another connection still holds
+        # open; keep serving the existing build until the next start
+        remove_quietly([tmp_path])
+
+def built_mtime(con):
+    has_meta = con.execute(
+        "SELECT 1 FROM duckdb_tables() WHERE table_name = ?", [META_TABLE]
+    ).fetchone()
+    if not has_meta:
+        return None
+    return con.execute(f"SELECT csv_mtime FROM {META_TABLE}").fetchone()[0]
+
+def open_db():
+    # attach into a fresh in-memory instance: duckdb.connect(DB_PATH) reuses
+    # any live instance for that path in this process, which would keep
+    # serving a file that build_db has since replaced
+    con = duckdb.connect(config=DUCKDB_CONFIG)
+    # ATTACH takes no bound parameters, so the path is quoted by hand
+    path = DB_PATH.replace("'", "''")
+    try:
+        con.execute(f"ATTACH '{path}' AS bi (READ_ONLY)")
+    except duckdb.Error:
+        con.close()
+        raise
+    con.execute("USE bi")
+    return con
+
+def open_current(csv_mtime):
+    # None when the file is missing, stale, or cannot be opened at all
+    try:
+        con = open_db()
+    except duckdb.Error:
+        return None
+    if built_mtime(con) == csv_mtime:
+        return con
+    con.close()
+    return None
 
 @st.cache_resource
-def get_con(df):
-    con = duckdb.connect(DB_PATH, read_only=False)
-    con.execute(f"DROP TABLE IF EXISTS {TABLE_NAME}")
-    con.execute(f"CREATE TABLE {TABLE_NAME} AS SELECT * FROM df")
+def get_con():
+    # the data is immutable: skip ingestion unless the CSV changed since the build
+    csv_mtime = os.path.getmtime(CSV_PATH)
+    con = open_current(csv_mtime)
+    if con is None:
+        # on POSIX, readers in this or other processes keep their old file
+        # open and never block the swap
+        build_db(csv_mtime)
+        con = open_db()
     return con
 
-df = load_df()
-con = get_con(df)
+con = get_con()
 
 # ================= INTENT DETECTION =================
-def detect_intent(q):
-    q = q.lower()
-
-    if any(w in q for w in ["how many", "count", "number"]):
-        return "COUNT"
-
-    if any(w in q for w in ["why", "reason", "cause"]):
-        return "WHY"
-
-    if any(w in q for w in ["distribution", "breakdown", "split"]):
-        return "DISTRIBUTION"
-
-    if any(w in q for w in ["most", "top", "highest"]):
-        return "TOP"
-
-    if any(w in q for w in ["problems", "facing"]):
-        return "PROBLEMS"
-
-    if any(w in q for w in ["overview", "summary", "analyze"]):
-        return "SUMMARY"
-
-    return "GENERAL"
+INTENT_PRIORITY = ["COUNT", "WHY", "DISTRIBUTION", "TOP", "PROBLEMS", "SUMMARY"]
+FILTER_TAGS = ["PENDING", "UNRESOLVED", "NEGATIVE", "SERVICE", "DELIVERY", "PRODUCT", "REFUND"]
+
+# one bit per tag; intents take the low bits in priority order
+BIT = {tag: 1 << i for i, tag in enumerate(INTENT_PRIORITY + FILTER_TAGS)}
+INTENT_BITS = (1 << len(INTENT_PRIORITY)) - 1
+INTENT_BY_BIT = {BIT[intent]: intent for intent in INTENT_PRIORITY}
+
+# whole words only, so each real inflection is listed: "accounts" must not
+# count as "count", nor "stop" as "top"
+KEYWORD_TAGS = {
+    # intents
+    "how many": "COUNT",
+    "count": "COUNT", "counts": "COUNT", "counted": "COUNT", "counting": "COUNT",
+    "number": "COUNT", "numbers": "COUNT",
+    "why": "WHY",
+    "reason": "WHY", "reasons": "WHY", "reasoning": "WHY",
+    "cause": "WHY", "causes": "WHY", "caused": "WHY", "causing": "WHY",
+    "distribution": "DISTRIBUTION", "distributions": "DISTRIBUTION",
+    "breakdown": "DISTRIBUTION", "breakdowns": "DISTRIBUTION",
+    "split": "DISTRIBUTION", "splits": "DISTRIBUTION", "splitting": "DISTRIBUTION",
+    "most": "TOP", "top": "TOP", "highest": "TOP",
+    "problem": "PROBLEMS", "problems": "PROBLEMS", "facing": "PROBLEMS",
+    "overview": "SUMMARY", "overviews": "SUMMARY",
+    "summary": "SUMMARY", "summaries": "SUMMARY",
+    "analyze": "SUMMARY", "analyzes": "SUMMARY", "analyzed": "SUMMARY", "analyzing": "SUMMARY",
+    # filters / topics
+    "pending": "PENDING", "unresolved": "UNRESOLVED",
+    "negative": "NEGATIVE", "frustrated": "NEGATIVE",
+    "service": "SERVICE", "services": "SERVICE", "satisfaction": "SERVICE",
+    "delivery": "DELIVERY", "deliveries": "DELIVERY",
+    "product": "PRODUCT", "products": "PRODUCT",
+    "refund": "REFUND", "refunds": "REFUND", "refunded": "REFUND",
+}
+
+TOKEN_RE = re.compile(r"[a-z]+")
+
+def build_trie(keyword_tags):
+    trie = {}
+    for keyword, tag in keyword_tags.items():
+        node = trie
+        for token in keyword.split():
+            node = node.setdefault(token, {})
+        node[None] = BIT[tag]
+    return trie
+
+KEYWORD_TRIE = build_trie(KEYWORD_TAGS)
+
+def scan_mask(q):
+    # tokenize once, then greedy longest match over the keyword trie
+    tokens = TOKEN_RE.findall(q.lower())
+    mask = 0
+    i = 0
+    while i < len(tokens):
+        node, match = KEYWORD_TRIE, None
+        j = i
+        while j < len(tokens) and tokens[j] in node:
+            node = node[tokens[j]]
+            j += 1
+            if None in node:
+                match = (j, node[None])
+        if match:
+            i, bit = match
+            mask |= bit
+        else:
+            i += 1
+    return mask
+
+def detect_intent(mask):
+    # lowest set intent bit is the highest-priority intent; none → GENERAL
+    intents = mask & INTENT_BITS
+    return INTENT_BY_BIT.get(intents & -intents, "GENERAL")
 
 # ================= SQL GENERATION =================
-def generate_sql(intent, q):
-    q = q.lower()
-
-    if intent == "COUNT":
-        if "pending" in q:
-            return f"SELECT COUNT(*) AS value FROM {TABLE_NAME} WHERE resolution_status='Pending'"
-        if "negative" in q or "frustrated" in q:
-            return f"SELECT COUNT(*) AS value FROM {TABLE_NAME} WHERE sentiment='Negative'"
-        return f"SELECT COUNT(*) AS value FROM {TABLE_NAME}"
-
-    if intent == "DISTRIBUTION":
-        return f"""
-        SELECT issue_type, sentiment, COUNT(*) AS count
-        FROM {TABLE_NAME}
-        GROUP BY issue_type, sentiment
-        """
-
-    if intent in ["TOP", "WHY", "SUMMARY", "PROBLEMS", "GENERAL"]:
-        if "pending" in q:
-            return f"""
-            SELECT issue_type, COUNT(*) AS count
-            FROM {TABLE_NAME}
-            WHERE resolution_status='Pending'
+# the whole query space; filter values are bound as parameters
+STATEMENTS = {
+    "count": f"SELECT COALESCE(SUM(count), 0)::BIGINT AS value FROM {AGG_TABLE}",
+    "count_by_status": f"""
+        SELECT COALESCE(SUM(count), 0)::BIGINT AS value FROM {AGG_TABLE}
+        WHERE resolution_status = ?
+        """,
+    "count_by_sentiment": f"""
+        SELECT COALESCE(SUM(count), 0)::BIGINT AS value FROM {AGG_TABLE}
+        WHERE sentiment = ?
+        """,
+    # pivoted and zero-filled in DuckDB so the result arrives chart-ready
+    "distribution": f"""
+        SELECT issue_type, COALESCE(COLUMNS(* EXCLUDE (issue_type)), 0)
+        FROM (
+            PIVOT {AGG_TABLE}
+            ON sentiment
+            USING SUM(count)::BIGINT
             GROUP BY issue_type
-            ORDER BY count DESC
-            """
-        return f"""
-        SELECT issue_type, COUNT(*) AS count
-        FROM {TABLE_NAME}
+        )
+        ORDER BY issue_type
+        """,
+    # share of all counted cases rides along from the window, so callers
+    # never re-add counts DuckDB already grouped
+    "by_issue": f"""
+        SELECT issue_type, SUM(count)::BIGINT AS count,
+               SUM(count) / SUM(SUM(count)) OVER () * 100 AS pct
+        FROM {AGG_TABLE}
         GROUP BY issue_type
         ORDER BY count DESC
-        """
+        """,
+    "by_issue_status": f"""
+        SELECT issue_type, SUM(count)::BIGINT AS count,
+               SUM(count) / SUM(SUM(count)) OVER () * 100 AS pct
+        FROM {AGG_TABLE}
+        WHERE resolution_status = ?
+        GROUP BY issue_type
+        ORDER BY count DESC
+        """,
+    # one matching issue type; QUALIFY filters after the window so pct
+    # is still relative to every issue type
+    "issue_share": f"""
+        SELECT issue_type, SUM(count)::BIGINT AS count,
+               SUM(count) / SUM(SUM(count)) OVER () * 100 AS pct
+        FROM {AGG_TABLE}
+        GROUP BY issue_type
+        QUALIFY issue_type ILIKE ?
+        ORDER BY count DESC
+        LIMIT 1
+        """,
+    "issue_share_status": f"""
+        SELECT issue_type, SUM(count)::BIGINT AS count,
+               SUM(count) / SUM(SUM(count)) OVER () * 100 AS pct
+        FROM {AGG_TABLE}
+        WHERE resolution_status = ?
+        GROUP BY issue_type
+        QUALIFY issue_type ILIKE ?
+        ORDER BY count DESC
+        LIMIT 1
+        """,
+}
+
+# WHY topics in priority order: (tag, issue_type pattern, label)
+TOPICS = [
+    ("SERVICE", "%general%", "Service"),
+    ("DELIVERY", "%delivery%", "Delivery"),
+    ("PRODUCT", "%product%", "Product"),
+    ("REFUND", "%refund%", "Refund"),
+]
+
+def find_topic(mask):
+    for tag, pattern, label in TOPICS:
+        if mask & BIT[tag]:
+            return pattern, label
+    return None
+
+# returns (statement key, params, output kind); the UI renders by output kind
+def generate_sql(intent, mask):
+    if intent == "COUNT":
+        if mask & BIT["PENDING"]:
+            return "count_by_status", ("Pending",), "KPI"
+        if mask & BIT["NEGATIVE"]:
+            return "count_by_sentiment", ("Negative",), "KPI"
+        return "count", (), "KPI"
 
-# ================= SUMMARY / WHY ENGINE =================
-def generate_text(intent, question, df):
-    q = question.lower()
+    if intent == "DISTRIBUTION":
+        return "distribution", (), "STACKED"
+
+    topic = find_topic(mask) if intent == "WHY" else None
+    if topic:
+        pattern, _ = topic
+        if mask & BIT["PENDING"]:
+            return "issue_share_status", ("Pending", pattern), "TEXT"
+        return "issue_share", (pattern,), "TEXT"
+
+    output = "BAR" if intent == "TOP" else "TEXT"
+    if mask & BIT["PENDING"]:
+        return "by_issue_status", ("Pending",), output
+    return "by_issue", (), output
+
+# KPI statements produce one value, fetched as a plain scalar
+SCALAR_STATEMENTS = {"count", "count_by_status", "count_by_sentiment"}
+
+def fetch(con, key, params):
+    cursor = con.execute(STATEMENTS[key], list(params))
+    if key in SCALAR_STATEMENTS:
+        return cursor.fetchone()[0]
+    return cursor.to_arrow_table()
+
+# every (statement key, params, output kind) generate_sql can return,
+# enumerated over all tag masks so it can never fall behind generate_sql
+@st.cache_resource
+def query_space():
+    return {generate_sql(detect_intent(mask), mask) for mask in range(1 << len(BIT))}
 
-    if df.empty:
+# the data is immutable and the query space is closed, so every result is
+# computed once per process
+@st.cache_resource
+def precompute(_con):
+    pairs = {(key, params) for key, params, _ in query_space()}
+    return {(key, params): fetch(_con, key, params) for key, params in pairs}
+
+results = precompute(con)
+
+# ================= SUMMARY / WHY ENGINE =================
+def generate_text(intent, mask, tbl):
+    if tbl.num_rows == 0:
         return "No data available."
 
-    total = df["count"].sum()
+    # rows arrive sorted with their share precomputed; only row 0's pct is needed
+    issues = tbl.column("issue_type").to_pylist()
+    pct = tbl.column("pct")[0].as_py()
 
     # ---------- WHY (INTENT-AWARE) ----------
     if intent == "WHY":
+        topic = find_topic(mask)
+        if topic:
+            _, label = topic
+            return (
+                f"{label} issues impact customers because they account for "
+                f"**{pct:.0f}%** of reported cases, indicating resolution and process gaps."
+            )
 
-        def explain(keyword, label):
-            sub = df[df["issue_type"].str.contains(keyword, case=False)]
-            if not sub.empty:
-                cnt = sub.iloc[0]["count"]
-                pct = (cnt / total) * 100
-                return (
-                    f"{label} issues impact customers because they account for "
-                    f"**{pct:.0f}%** of reported cases, indicating resolution and process gaps."
-                )
-            return None
-
-        if "service" in q or "satisfaction" in q:
-            return explain("general", "Service")
-
-        if "delivery" in q:
-            return explain("delivery", "Delivery")
-
-        if "product" in q:
-            return explain("product", "Product")
-
-        if "refund" in q:
-            return explain("refund", "Refund")
-
-        if "pending" in q or "unresolved" in q:
-            top = df.iloc[0]
-            pct = (top["count"] / total) * 100
+        if mask & (BIT["PENDING"] | BIT["UNRESOLVED"]):
             return (
-                f"Pending cases are increasing mainly due to **{top['issue_type']}** issues, "
+                f"Pending cases are increasing mainly due to **{issues[0]}** issues, "
                 f"which contribute **{pct:.0f}%** of unresolved cases."
             )
 
-        top = df.iloc[0]
-        pct = (top["count"] / total) * 100
         return (
-            f"The primary reason is **{top['issue_type']}** issues, "
+            f"The primary reason is **{issues[0]}** issues, "
             f"accounting for **{pct:.0f}%** of total cases."
         )
 
     # ---------- PROBLEMS / MULTI-ISSUE SUMMARY ----------
     if intent in ["PROBLEMS", "SUMMARY", "GENERAL"]:
-        top_issues = df.head(3)
-        issue_list = ", ".join(top_issues["issue_type"])
-        top = top_issues.iloc[0]
-        pct = (top["count"] / total) * 100
+        issue_list = ", ".join(issues[:3])
         return (
             f"Customers mainly face issues related to **{issue_list}**, "
-            f"with **{top['issue_type']}** being the most frequent, "
+            f"with **{issues[0]}** being the most frequent, "
             f"contributing **{pct:.0f}%** of reported cases."
         )
 
+# ================= CHARTS =================
+# returns (data, spec); the data keeps only the columns the spec encodes,
+# so the text-only pct never reaches the frontend
+def build_chart(output, tbl):
+    if output == "STACKED":
+        sentiments = [c for c in tbl.column_names if c != "issue_type"]
+        return tbl, {
+            "mark": "bar",
+            "transform": [{"fold": sentiments, "as": ["sentiment", "count"]}],
+            "encoding": {
+                "x": {"field": "issue_type", "type": "nominal"},
+                "y": {"field": "count", "type": "quantitative", "stack": True},
+                "color": {"field": "sentiment", "type": "nominal"},
+            },
+        }
+    return tbl.select(["issue_type", "count"]), {
+        "mark": "bar",
+        "encoding": {
+            "x": {"field": "issue_type", "type": "nominal"},
+            "y": {"field": "count", "type": "quantitative"},
+        },
+    }
+
+# charts built once per process as plain Vega-Lite specs; rendering them
+# skips the Altair to_dict() encoding st.altair_chart would redo on every rerun
+@st.cache_resource
+def precompute_charts(_results):
+    return {
+        (key, params): build_chart(output, _results[key, params])
+        for key, params, output in query_space()
+        if output in ("STACKED", "BAR")
+    }
+
+charts = precompute_charts(results)
+
 # ================= UI =================
 st.subheader("💬 Ask a question")
 question = st.text_input("Ask anything about customers, issues, sentiment, service…")
 
 if st.button("Ask") and question:
-    intent = detect_intent(question)
-    sql = generate_sql(intent, question)
-    result = con.execute(sql).fetchdf()
+    mask = scan_mask(question)
+    intent = detect_intent(mask)
+    key, params, output = generate_sql(intent, mask)
+    result = results[key, params]
 
     # COUNT → KPI
-    if intent == "COUNT":
-        st.metric("Result", int(result.iloc[0, 0]))
-
-    # WHY / SUMMARY / PROBLEMS → TEXT ONLY
-    elif intent in ["WHY", "SUMMARY", "PROBLEMS", "GENERAL"]:
-        st.success(generate_text(intent, question, result))
-
-    # DISTRIBUTION → CHART ONLY
-    elif intent == "DISTRIBUTION":
-        pivot = result.pivot(
-            index="issue_type",
-            columns="sentiment",
-            values="count"
-        ).fillna(0)
-        st.bar_chart(pivot)
-
-    # TOP → CHART ONLY
-    elif intent == "TOP":
-        st.bar_chart(result.set_index("issue_type"))
+    if output == "KPI":
+        st.metric("Result", result)
+
+    # WHY / SUMMARY / PROBLEMS / GENERAL → TEXT ONLY
+    elif output == "TEXT":
+        st.success(generate_text(intent, mask, result))
+
+    # DISTRIBUTION → STACKED CHART / TOP → BAR CHART
+    else:
+        data, spec = charts[key, params]
+        st.vega_lite_chart(data, spec, width="stretch")
 
 # ================= SIDEBAR =================
 st.sidebar.header("📌 Example Questions")